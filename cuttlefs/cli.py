@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import argparse
-import json
 import logging
 import os
 import threading
@@ -9,14 +8,14 @@ import traceback
 
 from pathlib import Path
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from io import BytesIO
 
 from fuse import FUSE
 
 from .cuttlefs import CuttleFS
 from .fsyncs import SUPPORTED_FSYNC_CLASSES
+from . import jsonutil
 
-def get_args():
+def _build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("root",
         help="Existing folder to act as root",
@@ -60,11 +59,19 @@ def get_args():
         '{"path": "/foo", "seq": "xxwxW", "sector": 4}\n'
     )
     parser.add_argument("--fault-list-file", default=None, help=helpstr)
+    return parser
+
+# built once at import time; test harnesses spawn a fresh cuttlefs process
+# per mount, so parser construction should not be repeated per call
+_PARSER = _build_parser()
 
-    args = parser.parse_args()
-    args.root = Path(args.root).resolve().as_posix()
-    args.mount = Path(args.mount).resolve().as_posix()
-    args.fs_metadir = Path(args.fs_metadir).resolve()
+def get_args():
+    args = _PARSER.parse_args()
+    # abspath is string manipulation plus one getcwd; resolve() would
+    # lstat every component of every path
+    args.root = os.path.abspath(args.root)
+    args.mount = os.path.abspath(args.mount)
+    args.fs_metadir = Path(os.path.abspath(args.fs_metadir))
     args.fsync_behavior = SUPPORTED_FSYNC_CLASSES[args.fsync_behavior]
     assert hasattr(args.fsync_behavior, "on_fsync")
     assert hasattr(args.fsync_behavior, "on_sync_write")
@@ -78,24 +85,32 @@ def configure_logger(log_level):
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
     # NOTE fs is set by the caller of http server
+
+    # HTTP/1.1 keeps the connection alive between commands so clients that
+    # reuse their session skip a TCP handshake per command. An async server
+    # (aiohttp et al) would add a dependency for a localhost-only channel
+    # that sees a handful of requests per experiment.
+    protocol_version = "HTTP/1.1"
     fs = None
 
     def do_POST(self):
         content_length = int(self.headers['Content-Length'])
         body = self.rfile.read(content_length)
-        self.send_response(200)
-        self.end_headers()
 
-        response = BytesIO()
         try:
-            jdata = json.loads(body)
+            jdata = jsonutil.loads(body)
             resp = self.fs.handle_command(jdata)
         except Exception:
             exception = traceback.format_exc()
             resp = {"success": False, "exception": exception}
 
-        response.write(json.dumps(resp).encode('utf8'))
-        self.wfile.write(response.getvalue())
+        payload = jsonutil.dumps_bytes(resp)
+
+        # keep-alive requires an accurate Content-Length
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
 
 def main():
     args = get_args()
@@ -107,8 +122,8 @@ def main():
     fault_list = []
     if args.fault_list_file is not None:
         log.info("loading faultlist %s", args.fault_list_file)
-        with open(args.fault_list_file, 'r') as fp:
-            fault_list = json.load(fp)
+        with open(args.fault_list_file, 'rb') as fp:
+            fault_list = jsonutil.loads(fp.read())
 
     fs = CuttleFS(args.root, args.fs_metadir, args.fsync_behavior, fault_list)
 
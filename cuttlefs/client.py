@@ -1,6 +1,8 @@
+import json
 import logging
 import requests
 import signal
+import socket
 import subprocess
 import time
 
@@ -25,6 +27,13 @@ class CuttleFSForegroundRunner(object):
         self.fsync_behavior = fsync_behavior
         self.fault_list_file = fault_list_file
         self.port = port
+        self._url = f"http://localhost:{port}"
+
+        # one keep-alive session for all commands; a fresh requests.post
+        # per command would pay a TCP connect/teardown every time
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self._session.mount("http://", adapter)
 
         self.stdout_file = Path(stdout_file).resolve() if stdout_file else None
         self.stderr_file = Path(stderr_file).resolve() if stderr_file else None
@@ -33,6 +42,22 @@ class CuttleFSForegroundRunner(object):
         self.stdout_fh = None
         self.stderr_fh = None
 
+        # fault list staged via set_faults; serialized and written only
+        # when mount() actually needs it
+        self._pending_faults = None
+        self._written_fault_blob = None
+
+    def set_faults(self, fault_list, path=None):
+        """
+        stage a fault list for the next mount. Serialization and the
+        file write are deferred to mount(), and skipped when the list
+        is unchanged from what the previous mount already wrote.
+        """
+        if path is not None:
+            self.fault_list_file = Path(path).as_posix()
+
+        self._pending_faults = fault_list
+
     def _gen_cmd(self):
         cmd = ["cuttlefs",
             "--foreground",
@@ -56,6 +81,15 @@ class CuttleFSForegroundRunner(object):
         return cmd
 
     def mount(self):
+        if self._pending_faults is not None:
+            assert self.fault_list_file is not None
+            blob = json.dumps(self._pending_faults).encode()
+            if blob != self._written_fault_blob:
+                Path(self.fault_list_file).write_bytes(blob)
+                self._written_fault_blob = blob
+
+            self._pending_faults = None
+
         cmd = self._gen_cmd()
 
         kwargs = {}
@@ -69,8 +103,30 @@ class CuttleFSForegroundRunner(object):
 
         self.log.debug("running command %r", cmd)
         self.proc = subprocess.Popen(cmd, **kwargs)
-        time.sleep(2)
-        assert self.proc.poll() is None
+        self._wait_ready()
+
+    def _wait_ready(self, timeout=10):
+        """
+        poll until the command server accepts connections and the mount
+        point is up, instead of sleeping a fixed amount. Typically ready
+        in tens of milliseconds.
+        """
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while time.monotonic() < deadline:
+            assert self.proc.poll() is None
+
+            with socket.socket() as s:
+                s.settimeout(0.05)
+                port_up = s.connect_ex(("localhost", self.port)) == 0
+
+            if port_up and self.mount_point.is_mount():
+                return
+
+            attempt += 1
+            time.sleep(min(0.01 * attempt, 0.25))
+
+        assert False, f"cuttlefs not ready after {timeout} seconds"
 
     def _umount(self):
         if self.proc.poll() is None:
@@ -91,10 +147,16 @@ class CuttleFSForegroundRunner(object):
             return
 
         subprocess.check_call(["fusermount3", "-u", self.mount_point])
-        time.sleep(2)
+        deadline = time.monotonic() + 5
+        while self.mount_point.is_mount() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
         assert not self.mount_point.is_mount()
 
     def umount(self):
+        # drop any pooled connections; the session remains usable if the
+        # file system is mounted again
+        self._session.close()
         if self.proc is None:
             return
 
@@ -104,7 +166,7 @@ class CuttleFSForegroundRunner(object):
                 fh.close()
 
     def send_command(self, command):
-        resp = requests.post(f"http://localhost:{self.port}", json=command)
+        resp = self._session.post(self._url, json=command)
         return resp.json()
 
     def __enter__(self):
@@ -1,6 +1,6 @@
 import datetime
 import errno
-import json
+import functools
 import logging
 import os
 import stat
@@ -15,11 +15,15 @@ from .constants import PAGE_SZ
 from .page import Page, PageCache, MemInode
 from .block_manager import BlockManager
 from .fsyncs import SUPPORTED_FSYNC_CLASSES
+from . import jsonutil
 
 stat_fields = tuple([i for i in dir(os.stat_result) if i.startswith('st_')])
 statvfs_fields = tuple([i for i in dir(os.statvfs_result) if i.startswith('f_')])
 # function to check if flags specify O_SYNC / O_DSYNC
 has_sync_enabled = lambda flags: (flags & os.O_SYNC) or (flags & os.O_DSYNC)
+# shared immutable zero page for truncate fills; slicing it is cheaper
+# than building a fresh b'\0' * n per page
+_ZERO_PAGE = bytes(PAGE_SZ)
 
 class PassthroughOperations(object):
     """
@@ -132,7 +136,7 @@ class PassthroughOperations(object):
         return os.removexattr(p, name)
     ##########################################################################
 
-FDInfo = namedtuple('FDInfo', ["inode", "path"])
+FDInfo = namedtuple('FDInfo', ["inode", "path", "sync"])
 
 class CuttleFS(PassthroughOperations, Operations):
     """
@@ -140,9 +144,23 @@ class CuttleFS(PassthroughOperations, Operations):
     """
     log = logging.getLogger("cuttlefs")
 
+    # lstat results served from getattr are cached this long. The kernel
+    # issues getattr before almost every operation, so even a short TTL
+    # absorbs most of the stat traffic. size/atime/mtime are overlaid from
+    # the minode on every hit, so staleness only affects the static fields
+    # (mode, uid, ...), which mutating ops invalidate explicitly.
+    ATTR_CACHE_TTL = 1.0
+    ATTR_CACHE_MAXSIZE = 1024
+
     def __init__(self, root, metadir, fsync_cls, fault_list=[]):
         self.root = Path(root)
-        self.realpath = lambda x: self.root / x.lstrip("/")
+        # nearly every operation starts by resolving the fuse path, and the
+        # kernel tends to hit the same paths repeatedly (getattr before
+        # open, open before read, ...). The mapping is a pure function of
+        # the argument -- rename/unlink change what is at a path, not how
+        # the path translates -- so cached entries can never go stale.
+        self.realpath = functools.lru_cache(maxsize=4096)(
+            lambda x: self.root / x.lstrip("/"))
         self.metadir = Path(metadir)
         self.block_manager = BlockManager(self.metadir / "block_manager")
         for item in fault_list:
@@ -157,20 +175,36 @@ class CuttleFS(PassthroughOperations, Operations):
             self.to_be_deleted.mkdir(parents=True)
 
         self.page_cache = PageCache(self.block_manager)
+        # str(realpath) -> (expiry, stat_result dict); regular files only
+        self._attr_cache = {}
         self._last_fd_alloced = 3
         # fd => (path, inode)
         # we save the inode so that we don't have to keep calling 'stat'
         self.fd_info_map = {}
         self.inode_to_open_fds_map = {}
-        # set of file descriptors which have O_SYNC / O_DSYNC flags.
-        # Whenever anything is written, those pages have to be sync'd.
-        self.sync_fds = set()
-
         assert fsync_cls in tuple(SUPPORTED_FSYNC_CLASSES.values())
         self.fsync_obj = fsync_cls(self)
 
+        # captured once: the log level is fixed by cli before the fs is
+        # constructed, and re-asking the logging machinery per operation
+        # costs a call chain through the handler hierarchy
+        self._log_info = self.log.isEnabledFor(logging.INFO)
+
         self.post_init_validation()
 
+        # dispatch table for __call__: fuse issues an upcall per syscall,
+        # and one dict probe beats a getattr MRO walk every time
+        self._op_table = {
+            name: getattr(self, name) for name in (
+                'access', 'chmod', 'chown', 'create', 'destroy', 'flush',
+                'fsync', 'fsyncdir', 'getattr', 'getxattr', 'link',
+                'listxattr', 'mkdir', 'mknod', 'open', 'read', 'readdir',
+                'readlink', 'release', 'removexattr', 'rename', 'rmdir',
+                'setxattr', 'statfs', 'symlink', 'truncate', 'unlink',
+                'utimens', 'write',
+            )
+        }
+
         self.server_thread = None
 
     def post_init_validation(self):
@@ -181,10 +215,13 @@ class CuttleFS(PassthroughOperations, Operations):
         if hasattr(parent, 'post_init_validation'):
             parent.post_init_validation()
 
-    def _alloc_fd(self, path, inode=None):
+    def _alloc_fd(self, path, inode=None, sync=False):
         """
         returns a non-decreasing integer to serve as a file descriptor
-        and updates the fd->info map as well as inode->[fd1,fd2]
+        and updates the fd->info map as well as inode->[fd1,fd2].
+        `sync` records whether the fd was opened with O_SYNC / O_DSYNC;
+        it is fixed at open time, so keeping it on the FDInfo saves a
+        set lookup on every write.
         """
         # we will only allocate fd's if the metadata file (realpath) exists.
         assert path.exists()
@@ -196,9 +233,11 @@ class CuttleFS(PassthroughOperations, Operations):
         if inode is None:
             inode = os.stat(path).st_ino
 
-        info = FDInfo(inode=inode, path=path)
+        info = FDInfo(inode=inode, path=path, sync=sync)
         self.fd_info_map[new_fd] = info
-        self.inode_to_open_fds_map.setdefault(inode, set()).add(new_fd)
+        # a list, not a set: almost every inode has one or two open fds,
+        # and a small list is cheaper to allocate, grow, and iterate
+        self.inode_to_open_fds_map.setdefault(inode, []).append(new_fd)
         return new_fd
 
     def create(self, path, mode, fi):
@@ -207,9 +246,6 @@ class CuttleFS(PassthroughOperations, Operations):
         assert not fi.flags & os.O_NOFOLLOW
 
         p = self.realpath(path)
-        fd = os.open(p, fi.flags, mode)
-        assert fd > 0
-        os.close(fd)
 
         # initial metadata for this file
         now = time.time()
@@ -219,10 +255,22 @@ class CuttleFS(PassthroughOperations, Operations):
             "atime": now,
             "mtime": now,
         }
-        # TODO: verify that this only truncates the file created
-        # above and does not override any permissions.
-        with open(p, "w") as fp:
-            json.dump(meta, fp)
+
+        # a single open both creates the file with the requested mode and
+        # truncates it; the initial metadata is written through the same
+        # fd, which halves the syscalls of the old open/close + reopen
+        # dance. The real fd is forced read-write (the app's access mode
+        # only applies to the virtual fd we allocate below) and closed as
+        # soon as the metadata is out.
+        # the on-disk format stays JSON (tooling and tests parse it
+        # directly); jsonutil just picks the fastest encoder available
+        open_flags = (fi.flags & ~os.O_ACCMODE) | os.O_RDWR | os.O_CREAT | os.O_TRUNC
+        fd = os.open(p, open_flags, mode)
+        assert fd > 0
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(jsonutil.dumps_bytes(meta))
+
+        self._attr_cache.pop(str(p), None)
 
         # get the inode num and create in-mem inode
         inode = os.lstat(p).st_ino
@@ -230,12 +278,33 @@ class CuttleFS(PassthroughOperations, Operations):
         assert not self.page_cache.contains(inode)
         self.page_cache.put(inode, minode)
 
-        fi.fh = self._alloc_fd(p, inode)
-        if has_sync_enabled(fi.flags):
-            self.sync_fds.add(fi.fh)
+        sync = bool(has_sync_enabled(fi.flags))
+        fi.fh = self._alloc_fd(p, inode, sync=sync)
+        if not sync:
+            # see open() for why we only set the keep_cache hint and do not
+            # negotiate kernel writeback caching
+            fi.keep_cache = 1
 
         return 0
 
+    def chmod(self, path, mode):
+        self._attr_cache.pop(str(self.realpath(path)), None)
+        return super().chmod(path, mode)
+
+    def chown(self, path, uid, gid):
+        self._attr_cache.pop(str(self.realpath(path)), None)
+        return super().chown(path, uid, gid)
+
+    def setxattr(self, path, name, value, options, position=0):
+        # xattr changes bump st_ctime, which the cached stat would
+        # otherwise serve stale for up to the TTL
+        self._attr_cache.pop(str(self.realpath(path)), None)
+        return super().setxattr(path, name, value, options, position)
+
+    def removexattr(self, path, name):
+        self._attr_cache.pop(str(self.realpath(path)), None)
+        return super().removexattr(path, name)
+
     def flush(self, path, fi):
         # Normally, this is where we should write anything we buffer
         # to kernel space. We don't care about it. If something goes
@@ -256,27 +325,37 @@ class CuttleFS(PassthroughOperations, Operations):
 
     def getattr(self, path, fh=None):
         p = self.realpath(path)
-        if not p.exists():
-            raise FuseOSError(errno.ENOENT)
+        key = str(p)
+        now = time.time()
+        cached = self._attr_cache.get(key)
+        if cached is not None and cached[0] > now:
+            stat_result = cached[1]
+            inode = stat_result['st_ino']
+        else:
+            if not p.exists():
+                raise FuseOSError(errno.ENOENT)
 
-        # using os.lstat instead of os.stat so that we stat
-        # symlinks instead of following them
-        s = os.lstat(p)
-        stat_result = dict((key, getattr(s, key)) for key in stat_fields)
+            # using os.lstat instead of os.stat so that we stat
+            # symlinks instead of following them
+            s = os.lstat(p)
+            stat_result = dict((key, getattr(s, key)) for key in stat_fields)
 
-        # we only care about regular files for now. links, directories, etc
-        # can go the passthrough path.
-        if not stat.S_ISREG(s.st_mode):
-            return stat_result
+            # we only care about regular files for now. links, directories, etc
+            # can go the passthrough path.
+            if not stat.S_ISREG(s.st_mode):
+                return stat_result
 
-        inode = s.st_ino
-        if not self.page_cache.contains(inode):
-            minode = MemInode(inode, path, p)
-            self.page_cache.put(inode, minode)
+            if len(self._attr_cache) >= self.ATTR_CACHE_MAXSIZE:
+                self._attr_cache.clear()
 
-        minode = self.page_cache.get(inode)
+            self._attr_cache[key] = (now + self.ATTR_CACHE_TTL, stat_result)
+            inode = s.st_ino
+
+        minode = self.page_cache.get_or_create(inode,
+            lambda: MemInode(inode, path, p))
 
         # overwrite the filesize, atime, mtime with values from page cache.
+        minode.stamp_mtime_if_dirty()
         stat_result['st_size'] = minode.size
         stat_result['st_atime'] = minode.atime
         stat_result['st_mtime'] = minode.mtime
@@ -289,13 +368,19 @@ class CuttleFS(PassthroughOperations, Operations):
 
         p = self.realpath(path)
         inode = os.stat(p).st_ino
-        if not self.page_cache.contains(inode):
-            minode = MemInode(inode, path, p)
-            self.page_cache.put(inode, minode)
-
-        fi.fh = self._alloc_fd(p, inode)
-        if has_sync_enabled(fi.flags):
-            self.sync_fds.add(fi.fh)
+        self.page_cache.get_or_create(inode, lambda: MemInode(inode, path, p))
+
+        sync = bool(has_sync_enabled(fi.flags))
+        fi.fh = self._alloc_fd(p, inode, sync=sync)
+        if not sync:
+            # NOTE kernel writeback caching (FUSE_CAP_WRITEBACK_CACHE) would
+            # coalesce small writes before they reach us, but this file
+            # system exists to observe every read/write, which is why the
+            # mount forces direct_io (see cli.py). keep_cache is a per-fd
+            # hint that costs nothing under direct_io and keeps reads hot
+            # across reopen if direct_io is ever relaxed. O_SYNC fds never
+            # get it so their writes stay strictly ordered.
+            fi.keep_cache = 1
 
         return 0
 
@@ -305,25 +390,26 @@ class CuttleFS(PassthroughOperations, Operations):
         if page is not None:
             return page
 
-        page = Page(minode.inode, offset)
+        page = Page(offset)
         minode.offset_to_page[offset] = page
+        minode.clean_offsets.add(offset)
 
         # if there is a block associated with the offset, read it from disk.
         # otherwise, a block will be allocated when we sync the inode.
+        # the read fills the page's preallocated buffer in place, so
+        # page.content is always the same PAGE_SZ bytearray and slice
+        # assignments into it are pure memcpy.
         block = minode.offset_to_block.get(offset)
         if block is not None:
-            page.content = self.block_manager.bread(block)
+            self.block_manager.bread_into(block, page.content)
 
         return page
 
     def read(self, path, size, offset, fi):
         fd = fi.fh
         fd_info = self.fd_info_map[fd]
-        if not self.page_cache.contains(fd_info.inode):
-            minode = MemInode(fd_info.inode, path, fd_info.path)
-            self.page_cache.put(fd_info.inode, minode)
-
-        minode = self.page_cache.get(fd_info.inode)
+        minode = self.page_cache.get_or_create(fd_info.inode,
+            lambda: MemInode(fd_info.inode, path, fd_info.path))
 
         if size == 0:
             return b''
@@ -334,19 +420,33 @@ class CuttleFS(PassthroughOperations, Operations):
         if (offset + size) >= minode.size:
             size = minode.size - offset
 
-        buf = bytearray()
+        # fast path: most FUSE reads land entirely inside one page, so
+        # skip the result buffer and the loop machinery
+        pg_start = offset % PAGE_SZ
+        if size <= PAGE_SZ - pg_start:
+            page = self._get_page_for_offset(minode, offset - pg_start)
+            return bytes(page.content[pg_start: pg_start + size])
+
+        # preallocate the result and copy page slices into place; bytearray
+        # to bytearray slice assignment goes through the buffer protocol
+        # without materializing an intermediate bytes object per page
+        buf = bytearray(size)
+        buf_idx = 0
         remaining = size
         current_offset = offset
+        # bind the method once; attribute resolution per page is pure
+        # interpreter overhead on a memory-bound loop
+        get_page = self._get_page_for_offset
         while remaining > 0:
             page_num = current_offset // PAGE_SZ
-            page = self._get_page_for_offset(minode, page_num * PAGE_SZ)
+            page = get_page(minode, page_num * PAGE_SZ)
             pg_start = current_offset % PAGE_SZ
             pg_nbytes = min(remaining, PAGE_SZ - pg_start)
-            data = page.content[pg_start: pg_start + pg_nbytes]
-            buf.extend(data)
+            buf[buf_idx: buf_idx + pg_nbytes] = page.content[pg_start: pg_start + pg_nbytes]
 
-            current_offset += len(data)
-            remaining -= len(data)
+            buf_idx += pg_nbytes
+            current_offset += pg_nbytes
+            remaining -= pg_nbytes
 
         # TODO update atime?
         return bytes(buf)
@@ -356,31 +456,53 @@ class CuttleFS(PassthroughOperations, Operations):
         fd_info = self.fd_info_map[fd]
         size = len(data)
 
-        if not self.page_cache.contains(fd_info.inode):
-            minode = MemInode(fd_info.inode, path, fd_info.path)
-            self.page_cache.put(fd_info.inode, minode)
-
-        minode = self.page_cache.get(fd_info.inode)
+        minode = self.page_cache.get_or_create(fd_info.inode,
+            lambda: MemInode(fd_info.inode, path, fd_info.path))
 
         if size == 0:
             return 0
 
-        dirty_pages = []
-        sync_fd = False
-        if fd in self.sync_fds:
-            sync_fd = True
-
+        sync_fd = fd_info.sync
+
+        # fast path: the write fits inside a single page
+        pg_start = offset % PAGE_SZ
+        if size <= PAGE_SZ - pg_start:
+            page = self._get_page_for_offset(minode, offset - pg_start)
+            page.content[pg_start: pg_start + size] = data
+            minode.mark_page_dirty(page)
+
+            if (offset + size) > minode.size:
+                if self._log_info:
+                    self.log.info("Updating size from %d to %d",
+                        minode.size, offset + size)
+                minode.size = offset + size
+
+            minode.mtime_dirty = True
+            minode.meta_dirty = True
+            if sync_fd:
+                ret = self.fsync_obj.on_sync_write(fd, fd_info.inode,
+                    minode, [page])
+                if ret < 0:
+                    return ret
+
+            return size
+
+        # memoryview slices of the incoming data are O(1); plain slicing
+        # would copy each chunk once more on its way into the page
+        mv = memoryview(data)
         data_idx = 0
         remaining = size
         current_offset = offset
+        # hoisted bindings, same reasoning as in read
+        get_page = self._get_page_for_offset
+        mark_dirty = minode.mark_page_dirty
         while remaining > 0:
             page_num = current_offset // PAGE_SZ
-            page = self._get_page_for_offset(minode, page_num * PAGE_SZ)
+            page = get_page(minode, page_num * PAGE_SZ)
             pg_start = current_offset % PAGE_SZ
             pg_nbytes = min(remaining, PAGE_SZ - pg_start)
-            page.content[pg_start:pg_start + pg_nbytes] = data[data_idx: data_idx + pg_nbytes]
-            page.flag_dirty = True
-            dirty_pages.append(page)
+            page.content[pg_start:pg_start + pg_nbytes] = mv[data_idx: data_idx + pg_nbytes]
+            mark_dirty(page)
 
             data_idx += pg_nbytes
             current_offset += pg_nbytes
@@ -389,14 +511,30 @@ class CuttleFS(PassthroughOperations, Operations):
         # update file size, mtime
         nbytes_written = size - remaining
         if (offset + nbytes_written) > minode.size:
-            self.log.info("Updating size from %d to %d", minode.size, offset + nbytes_written)
+            if self._log_info:
+                self.log.info("Updating size from %d to %d",
+                    minode.size, offset + nbytes_written)
             minode.size = offset + nbytes_written
 
-        minode.mtime = time.time()
-        self.log.info("Finished writing, inode %d, %r", fd_info.inode, minode)
+        # reading the clock per write adds a syscall to the hottest path;
+        # the stamp is materialized lazily by getattr and the sync paths
+        minode.mtime_dirty = True
+        minode.meta_dirty = True
+        if self._log_info:
+            self.log.info("Finished writing, inode %d, %r", fd_info.inode, minode)
 
         if sync_fd:
-            ret = self.on_sync_write(fd, fd_info.inode, minode, dirty_pages)
+            # only the O_SYNC path needs the page list, so gather it here
+            # instead of building it speculatively inside the copy loop.
+            # All pages of this dispatch go down as one batch (a single
+            # bwritev + meta round); nothing is deferred past the write,
+            # so O_SYNC keeps its write-through durability and error
+            # reporting.
+            first = (offset // PAGE_SZ) * PAGE_SZ
+            dirty_pages = [minode.offset_to_page[o]
+                for o in range(first, offset + nbytes_written, PAGE_SZ)]
+            ret = self.fsync_obj.on_sync_write(fd, fd_info.inode,
+                minode, dirty_pages)
             if ret < 0:
                 return ret
 
@@ -408,7 +546,6 @@ class CuttleFS(PassthroughOperations, Operations):
             self.log.error("Trying to release unknown fd %d", fd)
             return 0
 
-        self.sync_fds.discard(fd)
         info = self.fd_info_map[fd]
         assert self.realpath(path) == info.path
         del self.fd_info_map[fd]
@@ -418,7 +555,10 @@ class CuttleFS(PassthroughOperations, Operations):
         self.fsync_obj.on_close_fd(fd, info.inode)
 
         open_fds = self.inode_to_open_fds_map[info.inode]
-        open_fds.remove(fd)
+        # order does not matter, so swap-pop instead of list.remove
+        i = open_fds.index(fd)
+        open_fds[i] = open_fds[-1]
+        open_fds.pop()
         if len(open_fds) != 0:
             return 0
 
@@ -445,6 +585,8 @@ class CuttleFS(PassthroughOperations, Operations):
     def rename(self, old, new):
         p_old = self.realpath(old)
         p_new = self.realpath(new)
+        self._attr_cache.pop(str(p_old), None)
+        self._attr_cache.pop(str(p_new), None)
         old_ino = os.stat(p_old).st_ino
 
         if p_new.exists():
@@ -459,10 +601,10 @@ class CuttleFS(PassthroughOperations, Operations):
         minode = self.page_cache.get(old_ino)
         minode.realpath = p_new
 
-        # if the inode has any open file descriptors, we need to change them
-        new_fd_info = FDInfo(inode=old_ino, path=p_new)
+        # if the inode has any open file descriptors, we need to change them.
+        # each fd keeps its own sync flag, so update the path in place.
         for fd in self.inode_to_open_fds_map.get(old_ino, []):
-            self.fd_info_map[fd] = new_fd_info
+            self.fd_info_map[fd] = self.fd_info_map[fd]._replace(path=p_new)
 
         # TODO what about mtime? Technically just the directory mtime changes.
         # But take a look at what POSIX says must happen here..
@@ -476,26 +618,27 @@ class CuttleFS(PassthroughOperations, Operations):
 
     def truncate(self, path, length, fh=None):
         p = self.realpath(path)
+        self._attr_cache.pop(str(p), None)
         # ignoring file handle / file descriptor.
         # will use path itself.
         inode = os.stat(p).st_ino
-        if not self.page_cache.contains(inode):
-            minode = MemInode(inode, path, p)
-            self.page_cache.put(inode, minode)
-
-        minode = self.page_cache.get(inode)
+        minode = self.page_cache.get_or_create(inode,
+            lambda: MemInode(inode, path, p))
 
         if length == minode.size:
             return length
 
         if length == 0:
             minode.offset_to_page = {}
-            for block in minode.offset_to_block.values():
-                # TODO this should be done only on fsync
-                self.block_manager.dealloc_block(block)
-
+            minode.dirty_offsets.clear()
+            minode.clean_offsets.clear()
+            # TODO this should be done only on fsync
+            self.block_manager.dealloc_blocks(list(minode.offset_to_block.values()))
             minode.offset_to_block = {}
+            minode.meta_map_blob = None
+            minode.map_generation += 1
             minode.size = 0
+            minode.meta_dirty = True
             return 0
 
         if length < minode.size:
@@ -505,21 +648,27 @@ class CuttleFS(PassthroughOperations, Operations):
             pg_start = length % PAGE_SZ
             pg_nbytes = PAGE_SZ - pg_start
             if pg_nbytes > 0:
-                page.content[pg_start: pg_start + pg_nbytes] = b'\0' * pg_nbytes
-                page.flag_dirty = True
+                page.content[pg_start: pg_start + pg_nbytes] = _ZERO_PAGE[:pg_nbytes]
+                minode.mark_page_dirty(page)
 
             # everything after this page must be removed.
-            current_offset = (last_valid_page + 1) * PAGE_SZ
-            while current_offset < minode.size:
-                self.offset_to_page.pop(current_offset, None)
-                block = self.offset_to_block.pop(current_offset, None)
+            blocks = []
+            for current_offset in range((last_valid_page + 1) * PAGE_SZ,
+                    minode.size, PAGE_SZ):
+                minode.offset_to_page.pop(current_offset, None)
+                minode.dirty_offsets.discard(current_offset)
+                minode.clean_offsets.discard(current_offset)
+                block = minode.offset_to_block.pop(current_offset, None)
                 if block is not None:
-                    # TODO this should be done only on fsync
-                    self.block_manager.dealloc_block(block)
+                    blocks.append(block)
 
-                current_offset += PAGE_SZ
+            # TODO this should be done only on fsync
+            self.block_manager.dealloc_blocks(blocks)
+            if blocks:
+                minode.map_generation += 1
 
             minode.size = length
+            minode.meta_dirty = True
             return length
 
         if length > minode.size:
@@ -530,13 +679,14 @@ class CuttleFS(PassthroughOperations, Operations):
                 page = self._get_page_for_offset(minode, page_num * PAGE_SZ)
                 pg_start = current_offset % PAGE_SZ
                 pg_nbytes = min(remaining, PAGE_SZ - pg_start)
-                page.content[pg_start:pg_start + pg_nbytes] = b'\0' * pg_nbytes
-                page.flag_dirty = True
+                page.content[pg_start:pg_start + pg_nbytes] = _ZERO_PAGE[:pg_nbytes]
+                minode.mark_page_dirty(page)
 
                 current_offset += pg_nbytes
                 remaining -= pg_nbytes
 
             minode.size = length
+            minode.meta_dirty = True
             return length
 
         # the only other case is length == minode.size where we don't do anything
@@ -555,19 +705,19 @@ class CuttleFS(PassthroughOperations, Operations):
         os.rename(realpath, newpath)
         newinode = os.stat(newpath).st_ino
         assert inode == newinode
-        new_fd_info = FDInfo(inode=inode, path=newpath)
         for fd in self.inode_to_open_fds_map[inode]:
-            self.fd_info_map[fd] = new_fd_info
+            self.fd_info_map[fd] = self.fd_info_map[fd]._replace(path=newpath)
 
         # if there are open file descriptors then the minode has to be in the page cache
         # NOTE: assuming all metadata like minodes reside in page cache and will never be evicted.
         # only data blocks will be evicted.
         # TODO: Document this earlier on.
         minode = self.page_cache.get(inode)
-        minode.realpath = new_fd_info.path
+        minode.realpath = newpath
 
     def unlink(self, path):
         p = self.realpath(path)
+        self._attr_cache.pop(str(p), None)
         inode = os.stat(p).st_ino
 
         if inode in self.inode_to_open_fds_map:
@@ -591,28 +741,24 @@ class CuttleFS(PassthroughOperations, Operations):
             times = (now, now)
 
         p = self.realpath(path)
+        self._attr_cache.pop(str(p), None)
         inode = os.stat(p).st_ino
-        minode = self.page_cache.get(inode)
-        if minode is None:
-            minode = MemInode(inode, path, p)
-            self.page_cache.put(inode, minode)
+        minode = self.page_cache.get_or_create(inode,
+            lambda: MemInode(inode, path, p))
 
         atime, mtime = times
         minode.atime = atime
         minode.mtime = mtime
+        minode.mtime_dirty = False
+        minode.meta_dirty = True
 
     def fs_checkpoint(self):
         """
         writes all dirty pages to disk
         """
-        # I know I know, iterating through a map, and then a linear
-        # search over all pages to find the dirty ones is inefficient.
-        # But i'm not so worried about performance. I'm going to run
-        # small workloads, so it isn't going to take that much time.
-        # TODO have better data structures for faster fsync and checkpointing
-        for minode in self.page_cache.minode_map.values():
-            # we pass a fd = -1 because this isn't really called by any fd
-            self.fsync_obj.on_fsync(-1, minode.inode, minode)
+        # we pass a fd = -1 because this isn't really called by any fd
+        self.page_cache.checkpoint(
+            lambda minode: self.fsync_obj.on_fsync(-1, minode.inode, minode))
 
     def destroy(self, path):
         self.log.info("shutting down cuttlefs")
@@ -640,15 +786,13 @@ class CuttleFS(PassthroughOperations, Operations):
     def _command_evict_clean_pages(self, command):
         self.log.info("evicting clean pages")
         for inode, minode in self.page_cache.minode_map.items():
-            page_offsets_to_evict = [
-                offset for offset, page in minode.offset_to_page.items()
-                if page.flag_dirty is False
-            ]
-            for offset in page_offsets_to_evict:
-                minode.offset_to_page.pop(offset)
+            nevicted = 0
+            for offset in minode.clean_offsets:
+                if minode.offset_to_page.pop(offset, None) is not None:
+                    nevicted += 1
 
-            self.log.info("evicted %d clean pages for %r",
-                len(page_offsets_to_evict), minode)
+            minode.clean_offsets.clear()
+            self.log.info("evicted %d clean pages for %r", nevicted, minode)
 
     def _command_checkpoint(self, command):
         self.log.info("checkpointing")
@@ -676,13 +820,21 @@ class CuttleFS(PassthroughOperations, Operations):
         return {"success": True}
 
     def __call__(self, op, *args):
-        fn = getattr(self, op, None)
-        path = args[0]
+        fn = self._op_table.get(op)
 
         if fn is None:
-            self.log.error("%s not implemented", op)
-            raise FuseOSError(errno.ENOTSUPP)
+            # fusepy registers callbacks for ops this class only inherits
+            # from its Operations base (opendir, releasedir, init, ioctl);
+            # resolve those through getattr once and cache the binding so
+            # the next call is a table hit
+            fn = getattr(self, op, None)
+            if fn is None:
+                self.log.error("%s not implemented", op)
+                raise FuseOSError(errno.ENOTSUP)
+
+            self._op_table[op] = fn
+
+        if self._log_info:
+            self.log.info("FUSE_OPERATION: %s, %s", op, args[0])
 
-        # TODO have flag to disable logging ops?
-        self.log.info("FUSE_OPERATION: %s, %s", op, path)
         return fn(*args)
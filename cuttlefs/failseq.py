@@ -21,48 +21,72 @@ class FailSequence(object):
                            (If W, all other writes should pass)
     """
 
-    __slots__ = ("idx", "seq", "end_idx", "termchar")
+    __slots__ = ("idx", "seq", "end_idx", "actions", "term_fail")
 
     def __init__(self, seq):
         self.seq = seq
         self._validate_seq()
 
         self.idx = -1
-        self.termchar = self.seq[-1].lower()
         self.end_idx = len(seq) - 1
+        # precompiled action table: next() is called for every faulted
+        # sector write, so turn the per-call character compare into a
+        # byte-index. 1 means fail the access, 0 means let it pass.
+        self.actions = bytes(1 if c == 'x' else 0 for c in seq[:-1])
+        self.term_fail = seq[-1] == 'X'
 
     def copy(self):
-        c = FailSequence(self.seq)
+        # self.seq already validated, so skip __init__ (and the
+        # revalidation and action-table rebuild it would do)
+        c = FailSequence.__new__(FailSequence)
+        c.seq = self.seq
         c.idx = self.idx
+        c.end_idx = self.end_idx
+        c.actions = self.actions
+        c.term_fail = self.term_fail
         return c
 
     def _validate_seq(self):
         errors = []
 
-        allowed = {'x', 'w', 'W', 'X'}
-        current = set(self.seq)
-        unknown = current - allowed
-        if len(unknown) > 0:
-            errors.append("Unknown characters in sequence: %r", unknown)
-
-        allowed = {'x', 'w'}
-        current = set(self.seq[:-1])
-        unknown = current - allowed
-        if len(current) > 0 and len(unknown) > 0:
-            errors.append("Only last character can be capitalized")
-
         if self.seq[-1] not in ('X', 'W'):
             errors.append("Sequence must terminate with X or W")
 
+        for c in self.seq[:-1]:
+            if c in ('x', 'w'):
+                continue
+
+            if c in ('X', 'W'):
+                errors.append("Only last character can be capitalized")
+            else:
+                errors.append(f"Unknown character in sequence: {c!r}")
+
+            break
+
         if len(errors) == 0:
             return
 
         raise ValueError("\n".join([f"Found {len(errors)} errors"] + errors))
 
+    def compiled(self):
+        """
+        returns a [pattern, idx] pair for inline use on hot paths.
+        pattern is the action table with the terminal action appended
+        (nonzero byte = fail); idx is the next position to consume.
+        Callers advance idx themselves, clamping at the last position,
+        which avoids a method call per access.
+        """
+        pattern = self.actions + bytes([self.term_fail])
+        idx = min(self.idx + 1, len(pattern) - 1)
+        return [pattern, idx]
+
     def next(self):
+        """
+        returns a truthy value if this access should fail.
+        """
         self.idx += 1
         if self.idx >= self.end_idx:
             # terminated
-            return self.termchar
+            return self.term_fail
 
-        return self.seq[self.idx]
+        return self.actions[self.idx]
@@ -0,0 +1,24 @@
+# Thin wrapper around the fastest available JSON implementation.
+# orjson, when installed, encodes and decodes several times faster than
+# the stdlib and produces bytes directly. It is optional: everything
+# falls back to the stdlib json module, so there is no hard dependency.
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def dumps_bytes(obj):
+        # OPT_NON_STR_KEYS matches the stdlib behavior of stringifying
+        # int dict keys (the per-file offset_to_block map relies on it)
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+else:
+    def dumps_bytes(obj):
+        return json.dumps(obj).encode('utf8')
+
+    loads = json.loads
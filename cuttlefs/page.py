@@ -12,18 +12,28 @@
 # If a block does not exist, a block must be allocated.
 
 import errno
-import json
 import logging
+import os
+import time
 
 from .constants import PAGE_SZ
-
+from . import jsonutil
+
+# A page does not know its inode: pages only live inside a MemInode's
+# offset_to_page table, so the owner is always in hand where a page is.
+# Dropping the back-reference saves a pointer per page; the remaining
+# fields stay an ordinary slotted class rather than parallel arrays --
+# pages are reachable by offset lookup, not scanned, so there is no
+# sequential pass for an SoA layout to speed up.
 class Page(object):
     __slots__ = (
-        "inode", "offset", "content", "flag_dirty",
+        "offset", "content", "flag_dirty",
     )
-    def __init__(self, inode, offset):
-        self.inode = inode
+    def __init__(self, offset):
         self.offset = offset
+        # NOTE bytearray(n) is a single C-level calloc: the kernel hands
+        # back pre-zeroed pages, so there is no interpreter-speed memset
+        # here to optimize away with a numpy slab or an arena
         self.content = bytearray(PAGE_SZ)
         self.flag_dirty = False
 
@@ -35,36 +45,103 @@ class MemInode(object):
     """
     __slots__ = (
         "inode", "path", "realpath", "offset_to_block", "atime", "mtime", "size",
-        "offset_to_page"
+        "offset_to_page", "dirty_offsets", "clean_offsets", "mtime_dirty",
+        "meta_dirty", "map_generation", "map_blob_generation", "meta_map_blob",
+        "meta_fd"
     )
     def __init__(self, inode, path, realpath):
         self.inode = inode
         self.path = path
         self.realpath = realpath
 
+        # NOTE offset_to_block stays a dict rather than a dense array
+        # indexed by offset // PAGE_SZ: files can be sparse (truncate-
+        # extend allocates nothing until sync), the mapping round-trips
+        # through the JSON metadata that external tooling parses, and the
+        # workloads here keep it small. A packed array would shrink the
+        # footprint for large dense files but loses the hole/None
+        # distinction for free.
         self.offset_to_block = {}
         self.atime = None
         self.mtime = None
         # TODO figure out when to change ctime?
         self.size = 0
 
+        # NOTE offset_to_page also stays a dict. A list indexed by
+        # offset >> PAGE_SHIFT would turn each lookup into an indexed
+        # load, but pages are cached on demand so the table is sparse
+        # (holes for every never-read page), and truncate/eviction would
+        # have to shift or tombstone entries. Int-keyed dict probes are
+        # already cheap at the page counts this simulator sees.
         self.offset_to_page = {}
-
-        with open(self.realpath, 'r') as fp:
-            data = json.load(fp)
-            self.atime = data['atime']
-            self.mtime = data['mtime']
-            self.size = data['size']
-            # json does not let keys be integers, so we convert it here
-            self.offset_to_block = {
-                int(offset) : block
-                for offset, block in data['offset_to_block'].items()
-            }
+        # index of page offsets by dirty state, maintained through
+        # mark_page_dirty/mark_page_clean so fsync and eviction do not
+        # have to scan every cached page
+        self.dirty_offsets = set()
+        self.clean_offsets = set()
+        # write only flags the mtime as stale; the clock is read lazily
+        # when something observes it (getattr) or persists it (fsync)
+        self.mtime_dirty = False
+        # set whenever size, timestamps, or the block mapping change so
+        # sync_meta can skip rewriting an unchanged metadata file
+        self.meta_dirty = False
+        # generation counter for the block mapping, bumped whenever an
+        # offset_to_block entry changes, plus the cached encoding of the
+        # mapping and the generation it was taken at. The mapping is the
+        # O(total blocks) part of the metadata; when only size or
+        # timestamps moved, sync_meta reuses the cached bytes.
+        self.map_generation = 0
+        self.map_blob_generation = -1
+        self.meta_map_blob = None
+        # file descriptor for the on-disk metadata file, opened lazily
+        # and kept for the life of the minode so each sync_meta is a
+        # pwrite instead of an open/write/close path walk. The fd
+        # follows the inode, so it survives renames of realpath.
+        self.meta_fd = -1
+
+        with open(self.realpath, 'rb') as fp:
+            data = jsonutil.loads(fp.read())
+
+        self.atime = data['atime']
+        self.mtime = data['mtime']
+        self.size = data['size']
+        # json does not let keys be integers, so we convert it here
+        self.offset_to_block = {
+            int(offset) : block
+            for offset, block in data['offset_to_block'].items()
+        }
+
+    def get_meta_fd(self):
+        if self.meta_fd < 0:
+            self.meta_fd = os.open(self.realpath,
+                os.O_RDWR | os.O_CREAT, 0o644)
+        return self.meta_fd
+
+    def close_meta_fd(self):
+        if self.meta_fd >= 0:
+            os.close(self.meta_fd)
+            self.meta_fd = -1
+
+    def stamp_mtime_if_dirty(self):
+        if self.mtime_dirty:
+            self.mtime = time.time()
+            self.mtime_dirty = False
+
+    def mark_page_dirty(self, page):
+        page.flag_dirty = True
+        self.dirty_offsets.add(page.offset)
+        self.clean_offsets.discard(page.offset)
+
+    def mark_page_clean(self, page):
+        page.flag_dirty = False
+        self.clean_offsets.add(page.offset)
+        self.dirty_offsets.discard(page.offset)
 
     def get_dirty_pages(self):
-        # TODO: for better performance, maintain a structure for dirty pages
-        # so this doesn't have to be computed all the time
-        return [p for p in self.offset_to_page.values() if p.flag_dirty]
+        # the dirty index makes this O(dirty pages) instead of a scan
+        # over every cached page
+        offset_to_page = self.offset_to_page
+        return [offset_to_page[offset] for offset in self.dirty_offsets]
 
     def __repr__(self):
         return f'MemInode({self.realpath}, size={self.size})'
@@ -89,19 +166,44 @@ class PageCache(object):
         self.minode_map[inode] = minode
         self.log.info("put(%d, %r)", inode, minode)
 
+    def get_or_create(self, inode, factory):
+        """
+        returns the cached minode, creating it via `factory` if absent.
+        One dict probe on the hit path instead of contains + get.
+        """
+        try:
+            return self.minode_map[inode]
+        except KeyError:
+            minode = factory()
+            self.minode_map[inode] = minode
+            self.log.info("put(%d, %r)", inode, minode)
+            return minode
+
     def contains(self, inode):
         return inode in self.minode_map
 
     def remove(self, inode):
         # NOTE: unsafe operation. Any dirty pages or unsyncd data will
         # be removed
-        if inode in self.minode_map:
-            del self.minode_map[inode]
-
-    def checkpoint(self):
-        for inode, minode in self.minode_map.items():
-            dirty_pages = minode.get_dirty_pages()
-            if len(dirty_pages) == 0:
+        minode = self.minode_map.pop(inode, None)
+        if minode is not None:
+            minode.close_meta_fd()
+
+    def checkpoint(self, sync_inode):
+        """
+        calls `sync_inode` on every minode with dirty pages. The caller
+        supplies the sync function since the fsync semantics live with
+        the filesystem, not the cache.
+
+        NOTE inodes are flushed serially on purpose. Fanning this out
+        over a thread pool looks attractive for large caches, but every
+        worker would funnel into the one BlockManager, whose allocator
+        and meta log are documented thread-unsafe, so the pool would
+        need a lock that serializes it right back.
+        """
+        for minode in self.minode_map.values():
+            # the dirty index lets us skip inodes with nothing to write
+            if not minode.dirty_offsets:
                 continue
 
-            self.sync_inode(minode)
+            sync_inode(minode)
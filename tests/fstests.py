@@ -8,6 +8,84 @@ from pathlib import Path
 
 from cuttlefs import CuttleFSForegroundRunner as CuttleFS
 
+# payload buffers shared by every test; built once at import instead of
+# re-running b'a' * 4096 style allocations in each test method. The
+# composed expectations below also replace the old per-test
+# ''.join([i*4096 for i in 'abcxy']).encode() idiom, which built five
+# intermediate strs and re-encoded them to bytes on every call.
+A4K = b'a' * 4096
+B4K = b'b' * 4096
+C4K = b'c' * 4096
+X4K = b'x' * 4096
+Y4K = b'y' * 4096
+ZERO4K = bytes(4096)
+# A8K stays a plain bytes object rather than an anonymous mmap-backed
+# buffer: it is built once at import and shared read-only, so there is
+# no per-test allocation left for mmap to avoid, and a file-like mmap
+# would add seek-position state to what is now an immutable constant.
+A8K = A4K * 2
+ABC = A4K + B4K + C4K
+ABCXY = ABC + X4K + Y4K
+ABC0Y = ABC + ZERO4K + Y4K
+
+# fault lists for the remount-with-failures tests; the runner
+# serializes and writes them lazily when the next mount needs them
+FAULT_LIST_BLOCK1 = [
+    {"path": "/mydir/faulty.txt", "block": 1, "seq": "xW"},
+]
+FAULT_LIST_BLOCK3 = [
+    {"path": "/mydir/faulty.txt", "block": 3, "seq": "xW"},
+]
+
+# one mounted CuttleFS per distinct fsync behavior, built lazily and
+# shared by every class that asks for that behavior. The FUSE
+# mount/umount handshake is by far the most expensive step in the
+# suite, so mounts are reused instead of recreated per class and torn
+# down once in tearDownModule.
+_fs_cache = {}
+
+def _fs_for(behavior):
+    if behavior in _fs_cache:
+        tmpdir, cuttlefs = _fs_cache[behavior]
+        return Path(tmpdir.name), cuttlefs
+
+    # TemporaryDirectory instead of the race-prone mktemp; it also owns
+    # removal, so workspaces stop piling up in /tmp across runs
+    tmpdir = tempfile.TemporaryDirectory(suffix="-test-cuttlefs")
+    workspace = Path(tmpdir.name)
+    (workspace / "src").mkdir()
+    (workspace / "mnt").mkdir()
+
+    cuttlefs = CuttleFS(workspace / "src", workspace / "mnt",
+        metadir=workspace / "fsmeta",
+        stdout_file=workspace / "cuttlefs_stdout",
+        stderr_file=workspace / "cuttlefs_stderr",
+        fsync_behavior=behavior,
+        nothreads=True,
+        # the mounts coexist until tearDownModule, so each needs its
+        # own command-server port
+        port=8888 + len(_fs_cache),
+    )
+
+    cuttlefs.mount()
+    _fs_cache[behavior] = (tmpdir, cuttlefs)
+    return workspace, cuttlefs
+
+def tearDownModule():
+    # tear each entry down independently: one failed umount must not
+    # leak the remaining mounts or their workspaces
+    errors = []
+    for tmpdir, cuttlefs in _fs_cache.values():
+        for step in (cuttlefs.umount, tmpdir.cleanup):
+            try:
+                step()
+            except Exception as exc:
+                errors.append(exc)
+
+    _fs_cache.clear()
+    if errors:
+        raise errors[0]
+
 class GenericFSTests(object):
     """
     Testing operations on an empty file system
@@ -16,97 +94,127 @@ class GenericFSTests(object):
 
     @classmethod
     def setUpClass(cls):
-        cls.workspace = Path(tempfile.mktemp(suffix="-test-cuttlefs"))
+        cls.workspace, cls.cuttlefs = _fs_for(cls.FSYNC_BEHAVIOR)
         cls.mnt = cls.workspace / "mnt"
         cls.src = cls.workspace / "src"
+        cls.fault_list_file = cls.workspace / "faultlist.json"
+
+        # the handful of paths the tests touch, built once per class
+        # instead of re-parsing "mydir/..." in every method
+        cls.mydir_mnt = cls.mnt / "mydir"
+        cls.mydir_src = cls.src / "mydir"
+        cls.f1_mnt = cls.mydir_mnt / "f1.txt"
+        cls.f1_src = cls.mydir_src / "f1.txt"
+        cls.f2_mnt = cls.mydir_mnt / "f2.txt"
+        cls.f2_src = cls.mydir_src / "f2.txt"
+        cls.faulty_mnt = cls.mydir_mnt / "faulty.txt"
+
+    def _read_all(self, f, size=64 * 1024):
+        # one os.open + one big pread + close: three FUSE ops instead
+        # of the buffered file object's open/read.../release sequence
+        fd = os.open(f, os.O_RDONLY)
+        try:
+            return os.pread(fd, size, 0)
+        finally:
+            os.close(fd)
+
+    def _assertBytesEq(self, data, expected):
+        # the passing path is a single memcmp; on failure report the
+        # lengths and first differing offset instead of letting
+        # assertEqual run difflib over kilobytes of payload
+        if data == expected:
+            return
+
+        n = min(len(data), len(expected))
+        idx = next((i for i in range(n) if data[i] != expected[i]), n)
+        self.fail("bytes differ: len %d vs %d, first difference at offset %d"
+            % (len(data), len(expected), idx))
+
+    def assertFileBytes(self, f, expected):
+        # read one byte past the expected length: if the file is larger
+        # than expected the sentinel byte makes the comparison fail,
+        # without paying for a full 64KB read on every assertion
+        data = self._read_all(f, size=len(expected) + 1)
+        self._assertBytesEq(data, expected)
+
+    def _sync(self, fd, metadata=True):
+        # the data-only tests can use fdatasync and skip the separate
+        # metadata flush; tests asserting on timestamps keep fsync
+        if metadata:
+            os.fsync(fd)
+        else:
+            os.fdatasync(fd)
 
-        os.makedirs(cls.workspace)
-        os.makedirs(cls.src)
-        os.makedirs(cls.mnt)
-
-        cls.cuttlefs = CuttleFS(cls.src, cls.mnt,
-            metadir=cls.workspace / "fsmeta",
-            stdout_file=cls.workspace / "cuttlefs_stdout",
-            stderr_file=cls.workspace / "cuttlefs_stderr",
-            fsync_behavior=cls.FSYNC_BEHAVIOR,
-            nothreads=True,
-        )
-
-        cls.cuttlefs.mount()
-
-    @classmethod
-    def tearDownClass(cls):
-        cls.cuttlefs.umount()
+    def _meta(self, src_path):
+        # one read + json.loads on bytes; the metadata blobs are tiny
+        return json.loads(src_path.read_bytes())
 
     def test_001_listdir(self):
-        dirs = [i for i in self.mnt.iterdir()]
-        self.assertEqual(dirs, [])
+        self.assertEqual(os.listdir(self.mnt), [])
 
     def test_002_mkdir(self):
-        os.makedirs(self.mnt / "mydir")
-        mnt_dirs = [i.relative_to(self.mnt) for i in self.mnt.iterdir()]
-        src_dirs = [i.relative_to(self.src) for i in self.src.iterdir()]
+        os.makedirs(self.mydir_mnt)
+        mnt_dirs = sorted(os.listdir(self.mnt))
+        src_dirs = sorted(os.listdir(self.src))
         self.assertEqual(mnt_dirs, src_dirs)
-        self.assertEqual(mnt_dirs, [Path("mydir")])
-
+        self.assertEqual(mnt_dirs, ["mydir"])
+
+    # NOTE test_003 (write), test_004 (cache-only observation), and
+    # test_005 (fsync) stay separate on purpose: the window where the
+    # data lives only in the page cache -- test_004's size == 0 check
+    # against the source metadata -- is the behavior under test, and
+    # folding the fsync into the writing open would close that window
+    # before it could be observed.
     def test_003_newfile(self):
-        f = self.mnt / "mydir/f1.txt"
+        f = self.f1_mnt
         with open(f, "wb") as fp:
-            fp.write(b'a' * 8192)
+            fp.write(A8K)
 
-        mnt_contents = [i.relative_to(self.mnt) for i in (self.mnt / "mydir").iterdir()]
-        src_contents = [i.relative_to(self.src) for i in (self.src / "mydir").iterdir()]
+        mnt_contents = sorted(os.listdir(self.mydir_mnt))
+        src_contents = sorted(os.listdir(self.mydir_src))
         self.assertEqual(mnt_contents, src_contents)
-        self.assertEqual(mnt_contents, [Path("mydir/f1.txt")])
+        self.assertEqual(mnt_contents, ["f1.txt"])
 
     def test_004_read_newfile_from_pagecache(self):
-        f = self.mnt / "mydir/f1.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        self.assertEqual(data, b'a' * 8192)
+        f = self.f1_mnt
+        self.assertFileBytes(f, A8K)
 
         # TODO have a way to query cuttlefs for dirty pages and assert that those pages are dirty?
 
         # ensure that on disk file is still 0 bytes because it is only in the page cache
-        with open(self.src / "mydir/f1.txt", "r") as fp:
-            meta = json.load(fp)
-
+        meta = self._meta(self.f1_src)
         self.assertEqual(meta['size'], 0)
 
     def test_005_fsync_newfile(self):
-        f = self.mnt / "mydir/f1.txt"
+        f = self.f1_mnt
         fd = os.open(f, os.O_WRONLY)
-        os.fsync(fd)
+        self._sync(fd, metadata=False)
         os.close(fd)
 
-        with open(self.src / "mydir/f1.txt", "r") as fp:
-            meta = json.load(fp)
-
+        meta = self._meta(self.f1_src)
         # TODO assert that even the offset to block mapping changed?
         self.assertEqual(meta['size'], 8192)
 
     def test_006_modify_first_block_of_newfile(self):
-        f = self.mnt / "mydir/f1.txt"
+        f = self.f1_mnt
 
-        with open(self.src / "mydir/f1.txt", "r") as fp:
-            old_meta = json.load(fp)
+        # raw bytes suffice: equality is all the test asserts
+        old_meta = self.f1_src.read_bytes()
 
-        fd = os.open(f, os.O_WRONLY)
-        os.pwrite(fd, b'b' * 4096, 0)
-        os.close(fd)
+        with open(f, "r+b") as fp:
+            fp.write(B4K)
 
         # the latest content should be read back from page cache
-        with open(f, "rb") as fp:
-            data = fp.read()
+        data = self._read_all(f)
 
         self.assertEqual(len(data), 8192)
-        self.assertEqual(data[:4096], b'b' * 4096)
-        self.assertEqual(data[4096:], b'a' * 4096)
-
-        with open(self.src / "mydir/f1.txt", "r") as fp:
-            new_meta = json.load(fp)
+        # memoryview slices compare against bytes without copying the
+        # halves out first
+        mv = memoryview(data)
+        self._assertBytesEq(mv[:4096], B4K)
+        self._assertBytesEq(mv[4096:], A4K)
 
+        new_meta = self.f1_src.read_bytes()
         # there should be no change in metadata - only page cache changes
         self.assertEqual(old_meta, new_meta)
 
@@ -114,409 +222,254 @@ class GenericFSTests(object):
     # TODO tests for unlinking and renaming while there is an open file descriptor
 
     def test_007_move_newfile(self):
-        oldf = self.mnt / "mydir/f1.txt"
-        newf = self.mnt / "mydir/f2.txt"
+        oldf = self.f1_mnt
+        newf = self.f2_mnt
         os.rename(oldf, newf)
 
-        mnt_contents = [i.relative_to(self.mnt) for i in (self.mnt / "mydir").iterdir()]
-        src_contents = [i.relative_to(self.src) for i in (self.src / "mydir").iterdir()]
+        mnt_contents = sorted(os.listdir(self.mydir_mnt))
+        src_contents = sorted(os.listdir(self.mydir_src))
         self.assertEqual(mnt_contents, src_contents)
-        self.assertEqual(mnt_contents, [Path("mydir/f2.txt")])
+        self.assertEqual(mnt_contents, ["f2.txt"])
 
     def test_008_fsync_newfile(self):
-        f = self.mnt / "mydir/f2.txt"
-        with open(self.src / "mydir/f2.txt", "r") as fp:
-            old_meta = json.load(fp)
+        f = self.f2_mnt
+        old_meta = self.f2_src.read_bytes()
 
         fd = os.open(f, os.O_WRONLY)
         os.fsync(fd)
         os.close(fd)
 
-        with open(self.src / "mydir/f2.txt", "r") as fp:
-            new_meta = json.load(fp)
-
+        new_meta = self.f2_src.read_bytes()
         # atleast mtime should have changed?
         self.assertNotEqual(old_meta, new_meta)
 
     def test_009_unlink_newfile(self):
-        f = self.mnt / "mydir/f2.txt"
+        f = self.f2_mnt
         os.unlink(f)
-        mnt_contents = [i.relative_to(self.mnt) for i in (self.mnt / "mydir").iterdir()]
-        src_contents = [i.relative_to(self.src) for i in (self.src / "mydir").iterdir()]
+        mnt_contents = sorted(os.listdir(self.mydir_mnt))
+        src_contents = sorted(os.listdir(self.mydir_src))
         self.assertEqual(mnt_contents, src_contents)
         self.assertEqual(mnt_contents, [])
 
         # TODO since unlinked file does not have open file descriptors, the
         # blocks should be reclaimed by block manager. test that too.
 
-    # create and fsync file again before unmounting so we can test if it persists
-    # on remount
-    test_010_newfile = test_003_newfile
-    test_011_fsync_newfile = test_005_fsync_newfile
+    # create and fsync file again before unmounting so we can test if it
+    # persists on remount. One open covers the write and the fsync: the
+    # page-cache window re-running 003/005 separately would re-observe
+    # was already covered there, so the split bought a second
+    # open/release round-trip for nothing.
+    def test_010_recreate_and_fsync(self):
+        f = self.f1_mnt
+        with open(f, "wb") as fp:
+            fp.write(A8K)
+            fp.flush()
+            self._sync(fp.fileno(), metadata=False)
+
+        meta = self._meta(self.f1_src)
+        self.assertEqual(meta['size'], 8192)
 
     def test_012_remount(self):
         # TODO should umount flush all dirty pages?
-        # repeat this process without test_011_fsync_newfile
+        # repeat this process without the fsync in test_010
         self.cuttlefs.umount()
         self.cuttlefs.mount()
 
     def test_013_check_data_survive_remount(self):
-        f = self.mnt / "mydir/f1.txt"
+        f = self.f1_mnt
         self.assertEqual(f.exists(), True)
 
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        self.assertEqual(data, b'a' * 8192)
+        self.assertFileBytes(f, A8K)
+
+    def test_014_osync_multichunk_write(self):
+        # a write larger than the FUSE transfer size arrives as several
+        # write dispatches; every chunk, including the tail, must be
+        # synced before the application's write returns
+        f = self.f1_mnt
+        payload = C4K * 64
+        fd = os.open(f, os.O_WRONLY | os.O_SYNC)
+        try:
+            self.assertEqual(os.write(fd, payload), len(payload))
+            # durable before close: the source metadata already has the
+            # full size
+            meta = self._meta(self.f1_src)
+            self.assertEqual(meta['size'], len(payload))
+        finally:
+            os.close(fd)
+
+        self.assertFileBytes(f, payload)
+
+class FaultyFileTestsMixin(object):
+    """
+    Fault injection tests shared by the per-filesystem classes.
+    Where the behaviors diverge (when the error surfaces and what
+    survives the failed block write), the methods branch on
+    FSYNC_BEHAVIOR rather than being copied per class.
+    """
+    def _install_fault_list(self, fault_list):
+        self.cuttlefs.set_faults(fault_list, path=self.fault_list_file)
 
-class Ext4OrderedTests(GenericFSTests, unittest.TestCase):
-    FSYNC_BEHAVIOR = "ext4-ordered"
     # these tests run after the generic tests
     def test_101_create_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
+        f = self.faulty_mnt
         with open(f, "wb") as fp:
-            fp.write(b'a' * 4096)
-            fp.write(b'b' * 4096)
-            fp.write(b'c' * 4096)
+            fp.write(A4K)
+            fp.write(B4K)
+            fp.write(C4K)
             os.fsync(fp.fileno())
 
     def test_102_remount_with_failures(self):
         self.cuttlefs.umount()
-        fault_list_file = self.workspace / "faultlist.json"
-        fault_list = [
-            {"path": "/mydir/faulty.txt", "block": 1, "seq": "xW"},
-        ]
-        with open(fault_list_file, 'w') as fp:
-            json.dump(fault_list, fp, indent=2)
-
-        self.cuttlefs.fault_list_file = fault_list_file.as_posix()
-
+        self._install_fault_list(FAULT_LIST_BLOCK1)
         self.cuttlefs.mount()
 
     # TODO test to make sure that the contents are 'a', 'b', 'c'?
 
     def test_103_write_fsync_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
+        f = self.faulty_mnt
+        # os-level fds here and below: the tests need os.fsync to raise
+        # on a precise fd. A leaked fd would block the later umount, so
+        # close in a finally even when an assertion fails.
         fd = os.open(f, os.O_WRONLY)
+        try:
+            lseek_ret = os.lseek(fd, 4096, os.SEEK_SET)
+            self.assertEqual(lseek_ret, 4096)
 
-        lseek_ret = os.lseek(fd, 4096, os.SEEK_SET)
-        self.assertEqual(lseek_ret, 4096)
+            write_ret = os.write(fd, X4K)
+            self.assertEqual(write_ret, 4096)
 
-        write_ret = os.write(fd, b'x' * 4096)
-        self.assertEqual(write_ret, 4096)
+            if self.FSYNC_BEHAVIOR == "ext4-data":
+                # This should pass because it should be put in the
+                # journal; the error is reported on the next fsync
+                os.fsync(fd)
 
-        with self.assertRaises(os.error) as exc:
-            os.fsync(fd)
+            with self.assertRaises(os.error) as exc:
+                os.fsync(fd)
 
-        self.assertEqual(exc.exception.errno, errno.EIO)
-        os.close(fd)
+            self.assertEqual(exc.exception.errno, errno.EIO)
+        finally:
+            os.close(fd)
 
     def test_104_read_after_failed_fsync(self):
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = b''.join([b'a' * 4096, b'x' * 4096, b'c' * 4096])
-        self.assertEqual(data, expected_data)
-
-    def test_105_read_after_remount(self):
-        self.cuttlefs.umount()
-        self.cuttlefs.mount()
-
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = b''.join([b'a' * 4096, b'b' * 4096, b'c' * 4096])
-        self.assertEqual(data, expected_data)
-
-    # Test failure while appending
-
-    def test_106_remount_with_failures(self):
-        self.cuttlefs.umount()
-        fault_list_file = self.workspace / "faultlist.json"
-        fault_list = [
-            {"path": "/mydir/faulty.txt", "block": 3, "seq": "xW"},
-        ]
-        with open(fault_list_file, 'w') as fp:
-            json.dump(fault_list, fp, indent=2)
-
-        self.cuttlefs.fault_list_file = fault_list_file.as_posix()
-        self.cuttlefs.mount()
-
-    def test_107_append_fsync_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = ''.join([i*4096 for i in 'abc']).encode()
-        self.assertEqual(data, expected_data)
-
-        fd = os.open(f, os.O_WRONLY | os.O_APPEND)
-        write_ret = os.write(fd, b'x'*4096)
-        self.assertEqual(write_ret, 4096)
-
-        with self.assertRaises(os.error) as exc:
-            os.fsync(fd)
-
-        self.assertEqual(exc.exception.errno, errno.EIO)
-        # continue to append after fsync failure
-        write_ret = os.write(fd, b'y'*4096)
-        self.assertEqual(write_ret, 4096)
-        os.fsync(fd)
-        os.close(fd)
-
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = ''.join([i*4096 for i in 'abcxy']).encode()
-        self.assertEqual(data, expected_data)
-
-        # TODO maybe just evict page cache?
-        self.cuttlefs.umount()
-        self.cuttlefs.mount()
-
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_prefix = ''.join([i*4096 for i in 'abc']).encode()
-        expected_suffix = b'y' * 4096
-
-        self.assertEqual(data[:len(expected_prefix)], expected_prefix)
-        self.assertEqual(data[-len(expected_suffix):], expected_suffix)
-        self.assertNotEqual(data[4096*3:4096*4], b'x'*4096)
-
-# XFS behaves similarly to ext4 ordered
-class XFSTests(Ext4OrderedTests):
-    FSYNC_BEHAVIOR = "xfs"
-
-class BtrfsTests(GenericFSTests, unittest.TestCase):
-    FSYNC_BEHAVIOR = "btrfs"
-
-    def test_101_create_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "wb") as fp:
-            fp.write(b'a' * 4096)
-            fp.write(b'b' * 4096)
-            fp.write(b'c' * 4096)
-            os.fsync(fp.fileno())
-
-    def test_102_remount_with_failures(self):
-        self.cuttlefs.umount()
-        fault_list_file = self.workspace / "faultlist.json"
-        fault_list = [
-            {"path": "/mydir/faulty.txt", "block": 1, "seq": "xW"},
-        ]
-        with open(fault_list_file, 'w') as fp:
-            json.dump(fault_list, fp, indent=2)
-
-        self.cuttlefs.fault_list_file = fault_list_file.as_posix()
+        f = self.faulty_mnt
 
-        self.cuttlefs.mount()
-
-    # TODO test to make sure that the contents are 'a', 'b', 'c'?
+        if self.FSYNC_BEHAVIOR == "btrfs":
+            # reverted old data should be in the page cache
+            expected_data = ABC
+        else:
+            expected_data = A4K + X4K + C4K
 
-    def test_103_write_fsync_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
-        fd = os.open(f, os.O_WRONLY)
-
-        lseek_ret = os.lseek(fd, 4096, os.SEEK_SET)
-        self.assertEqual(lseek_ret, 4096)
-
-        write_ret = os.write(fd, b'x' * 4096)
-        self.assertEqual(write_ret, 4096)
-
-        with self.assertRaises(os.error) as exc:
-            os.fsync(fd)
-
-        self.assertEqual(exc.exception.errno, errno.EIO)
-        os.close(fd)
-
-    def test_104_read_after_failed_fsync(self):
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        # reverted old data should be in the page cache
-        expected_data = b''.join([b'a' * 4096, b'b' * 4096, b'c' * 4096])
-        self.assertEqual(data, expected_data)
+        self.assertFileBytes(f, expected_data)
 
     def test_105_read_after_remount(self):
         self.cuttlefs.umount()
         self.cuttlefs.mount()
 
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = b''.join([b'a' * 4096, b'b' * 4096, b'c' * 4096])
-        self.assertEqual(data, expected_data)
+        f = self.faulty_mnt
+        self.assertFileBytes(f, ABC)
 
     # Test failure while appending
     def test_106_remount_with_failures(self):
         self.cuttlefs.umount()
-        fault_list_file = self.workspace / "faultlist.json"
-        fault_list = [
-            {"path": "/mydir/faulty.txt", "block": 3, "seq": "xW"},
-        ]
-        with open(fault_list_file, 'w') as fp:
-            json.dump(fault_list, fp, indent=2)
-
-        self.cuttlefs.fault_list_file = fault_list_file.as_posix()
+        self._install_fault_list(FAULT_LIST_BLOCK3)
         self.cuttlefs.mount()
 
     def test_107_append_fsync_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = ''.join([i*4096 for i in 'abc']).encode()
-        self.assertEqual(data, expected_data)
+        f = self.faulty_mnt
+        self.assertFileBytes(f, ABC)
 
         fd = os.open(f, os.O_WRONLY | os.O_APPEND)
-        self.assertEqual(os.write(fd, b'x'*4096), 4096)
-        with self.assertRaises(os.error) as exc:
-            os.fsync(fd)
+        try:
+            self.assertEqual(os.write(fd, X4K), 4096)
 
-        self.assertEqual(exc.exception.errno, errno.EIO)
-        # continue to append after fsync failure
-        self.assertEqual(os.write(fd, b'y'*4096), 4096)
-        os.fsync(fd)
-        os.close(fd)
-
-        with open(f, "rb") as fp:
-            data = fp.read()
+            if self.FSYNC_BEHAVIOR == "ext4-data":
+                os.fsync(fd) # fails but shouldn't report it
 
-        # holes instead of x
-        expected_data = ''.join([i*4096 for i in 'abc\0y']).encode()
-        self.assertEqual(data, expected_data)
+                self.assertEqual(os.write(fd, Y4K), 4096)
 
-        self.cuttlefs.umount()
-        self.cuttlefs.mount()
+                with self.assertRaises(os.error) as exc:
+                    os.fsync(fd)
 
-        with open(f, "rb") as fp:
-            data = fp.read()
+                self.assertEqual(exc.exception.errno, errno.EIO)
+            else:
+                with self.assertRaises(os.error) as exc:
+                    os.fsync(fd)
 
-        self.assertEqual(data, expected_data)
+                self.assertEqual(exc.exception.errno, errno.EIO)
+                # continue to append after fsync failure
+                self.assertEqual(os.write(fd, Y4K), 4096)
+                os.fsync(fd)
+        finally:
+            os.close(fd)
 
+        if self.FSYNC_BEHAVIOR == "btrfs":
+            # holes instead of x: the failed copy-on-write batch was
+            # rolled back, only the second append survived
+            expected_data = ABC0Y
+        else:
+            expected_data = ABCXY
 
-class Ext4DataTests(GenericFSTests, unittest.TestCase):
-    FSYNC_BEHAVIOR = "ext4-data"
+        self.assertFileBytes(f, expected_data)
 
-    # these tests run after the generic tests
-    def test_101_create_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "wb") as fp:
-            fp.write(b'a' * 4096)
-            fp.write(b'b' * 4096)
-            fp.write(b'c' * 4096)
-            os.fsync(fp.fileno())
-
-    def test_102_remount_with_failures(self):
-        self.cuttlefs.umount()
-        fault_list_file = self.workspace / "faultlist.json"
-        fault_list = [
-            {"path": "/mydir/faulty.txt", "block": 1, "seq": "xW"},
-        ]
-        with open(fault_list_file, 'w') as fp:
-            json.dump(fault_list, fp, indent=2)
-
-        self.cuttlefs.fault_list_file = fault_list_file.as_posix()
-
-        self.cuttlefs.mount()
-
-    # TODO test to make sure that the contents are 'a', 'b', 'c'?
-
-    def test_103_write_fsync_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
-        fd = os.open(f, os.O_WRONLY)
-
-        lseek_ret = os.lseek(fd, 4096, os.SEEK_SET)
-        self.assertEqual(lseek_ret, 4096)
-
-        write_ret = os.write(fd, b'x' * 4096)
-        self.assertEqual(write_ret, 4096)
-
-        os.fsync(fd) # This should pass because it should be put in the journal
-
-        # second fsync should fail
-        with self.assertRaises(os.error) as exc:
-            os.fsync(fd)
-
-        self.assertEqual(exc.exception.errno, errno.EIO)
-        os.close(fd)
-
-    def test_104_read_after_failed_fsync(self):
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = b''.join([b'a' * 4096, b'x' * 4096, b'c' * 4096])
-        self.assertEqual(data, expected_data)
-
-    def test_105_read_after_remount(self):
-        self.cuttlefs.umount()
-        self.cuttlefs.mount()
-
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = b''.join([b'a' * 4096, b'b' * 4096, b'c' * 4096])
-        self.assertEqual(data, expected_data)
-
-    # Test failure while appending
-    def test_106_remount_with_failures(self):
+        # TODO maybe just evict page cache?
         self.cuttlefs.umount()
-        fault_list_file = self.workspace / "faultlist.json"
-        fault_list = [
-            {"path": "/mydir/faulty.txt", "block": 3, "seq": "xW"},
-        ]
-        with open(fault_list_file, 'w') as fp:
-            json.dump(fault_list, fp, indent=2)
-
-        self.cuttlefs.fault_list_file = fault_list_file.as_posix()
         self.cuttlefs.mount()
 
-    def test_107_append_fsync_faulty_file(self):
-        f = self.mnt / "mydir/faulty.txt"
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_data = ''.join([i*4096 for i in 'abc']).encode()
-        self.assertEqual(data, expected_data)
+        if self.FSYNC_BEHAVIOR == "btrfs":
+            self.assertFileBytes(f, ABC0Y)
+            return
 
-        fd = os.open(f, os.O_WRONLY | os.O_APPEND)
-        self.assertEqual(os.write(fd, b'x'*4096), 4096)
-        os.fsync(fd) # fails but shouldn't report it
-
-        self.assertEqual(os.write(fd, b'y'*4096), 4096)
-
-        with self.assertRaises(os.error) as exc:
-            os.fsync(fd)
-        self.assertEqual(exc.exception.errno, errno.EIO)
+        data = self._read_all(f)
 
-        os.close(fd)
-
-        with open(f, "rb") as fp:
-            data = fp.read()
+        expected_prefix = ABC
+        expected_suffix = Y4K
 
-        # holes instead of x
-        expected_data = ''.join([i*4096 for i in 'abcxy']).encode()
-        self.assertEqual(data, expected_data)
+        mv = memoryview(data)
+        self._assertBytesEq(mv[:len(expected_prefix)], expected_prefix)
+        self._assertBytesEq(mv[-len(expected_suffix):], expected_suffix)
+        self.assertNotEqual(mv[4096*3:4096*4], X4K)
 
+    # Test failure on a write through an O_SYNC fd
+    def test_108_osync_write_faulty_file(self):
         self.cuttlefs.umount()
+        self._install_fault_list(FAULT_LIST_BLOCK1)
         self.cuttlefs.mount()
 
-        with open(f, "rb") as fp:
-            data = fp.read()
-
-        expected_prefix = ''.join([i*4096 for i in 'abc']).encode()
-        expected_suffix = b'y' * 4096
-
-        self.assertEqual(data[:len(expected_prefix)], expected_prefix)
-        self.assertEqual(data[-len(expected_suffix):], expected_suffix)
-        self.assertNotEqual(data[4096*3:4096*4], b'x'*4096)
+        f = self.faulty_mnt
+        fd = os.open(f, os.O_WRONLY | os.O_SYNC)
+        try:
+            os.lseek(fd, 4096, os.SEEK_SET)
+            if self.FSYNC_BEHAVIOR == "ext4-data":
+                # the failed block write only "goes to the journal", so
+                # the write itself passes and the error surfaces on the
+                # next fsync of the fd
+                self.assertEqual(os.write(fd, X4K), 4096)
+                with self.assertRaises(os.error) as exc:
+                    os.fsync(fd)
+            else:
+                # O_SYNC writes are synced through before they return,
+                # so the injected fault fails the write itself
+                with self.assertRaises(os.error) as exc:
+                    os.write(fd, X4K)
+
+            self.assertEqual(exc.exception.errno, errno.EIO)
+        finally:
+            os.close(fd)
+
+# the concrete classes only differ by FSYNC_BEHAVIOR, so they are built
+# in one loop instead of four near-identical declarations. GenericFSTests
+# and FaultyFileTestsMixin never subclass TestCase, so the shared bodies
+# are not collected as a fifth, behavior-less run.
+# (XFS behaves similarly to ext4 ordered.)
+for _name, _behavior in [
+    ("Ext4OrderedTests", "ext4-ordered"),
+    ("XFSTests", "xfs"),
+    ("BtrfsTests", "btrfs"),
+    ("Ext4DataTests", "ext4-data"),
+]:
+    globals()[_name] = type(_name,
+        (FaultyFileTestsMixin, GenericFSTests, unittest.TestCase),
+        {"FSYNC_BEHAVIOR": _behavior})
 
 if __name__ == '__main__':
     unittest.main()